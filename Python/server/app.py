@@ -1,8 +1,11 @@
-from flask import Flask, render_template, request, redirect, jsonify
+from flask import Flask, render_template, request, redirect, jsonify, Response
 import os
+import re
+import mmap
+import zlib
 import subprocess
-import glob
-import json
+import orjson
+from waitress import serve
 
 app = Flask(__name__)
 
@@ -14,22 +17,61 @@ PYTHON_DIR = os.path.join(BASE_DIR, '..')
 ASSETS_DIR = os.path.join(PYTHON_DIR, 'Assets')
 CONFIG_PATH = os.path.join(PYTHON_DIR, 'moon_rover_config.yaml')
 RESULTS_DIR = os.path.join(PYTHON_DIR, 'results')
+# Map files at least this big are parsed from a memory map instead of a read() copy
+MMAP_THRESHOLD = 64 * 1024
+
+# Run IDs are passed to mlagents-learn as an argument and used as a folder name
+RUN_ID_PATTERN = re.compile(r'[A-Za-z0-9_\-]+')
+# Launch each tool in its own console window (Windows only, 0 elsewhere)
+NEW_CONSOLE = getattr(subprocess, 'CREATE_NEW_CONSOLE', 0)
+
+def console_command(title, cmd):
+    """On Windows, runs cmd under 'cmd /k' so the titled window stays open to show errors after exit."""
+    if os.name != 'nt':
+        return cmd
+    # Title words are separate arguments so none of them get quoted into the window title
+    return ['cmd', '/k', 'title', *title.split(), '&&', *cmd]
+
+# --- IN-PROCESS CACHES ---
+# Re-read only when the file/folder changes on disk (keyed on stat results)
+_yaml_cache = {"key": None, "content": None}
+_runs_cache = {"mtime": None, "runs": []}
+
+def read_config():
+    # Raw text is kept (not parsed) to preserve comments in the editor
+    try:
+        st = os.stat(CONFIG_PATH)
+    except FileNotFoundError:
+        return "# Config file not found!"
+
+    key = (st.st_mtime_ns, st.st_size)
+    if _yaml_cache["key"] != key:
+        with open(CONFIG_PATH, 'r') as f:
+            _yaml_cache["content"] = f.read()
+        _yaml_cache["key"] = key
+    return _yaml_cache["content"]
+
+def list_runs():
+    try:
+        mtime = os.stat(RESULTS_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    # A folder's mtime changes whenever an entry is added, removed or renamed
+    if _runs_cache["mtime"] != mtime:
+        # List directories only (DirEntry.is_dir reuses the type from readdir, no extra stat)
+        with os.scandir(RESULTS_DIR) as it:
+            _runs_cache["runs"] = [e.name for e in it if e.is_dir(follow_symlinks=False)]
+        _runs_cache["mtime"] = mtime
+    return _runs_cache["runs"]
 
 @app.route('/')
 def index():
     # 1. Read the YAML file as raw text to preserve comments
-    if os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH, 'r') as f:
-            yaml_content = f.read()
-    else:
-        yaml_content = "# Config file not found!"
+    yaml_content = read_config()
 
     # 2. Scan 'results' folder for existing Run IDs
-    existing_runs = []
-    if os.path.exists(RESULTS_DIR):
-        # List directories only
-        existing_runs = [d for d in os.listdir(RESULTS_DIR) 
-                         if os.path.isdir(os.path.join(RESULTS_DIR, d))]
+    existing_runs = list_runs()
     
     return render_template('index.html', yaml_content=yaml_content, runs=existing_runs)
 
@@ -39,34 +81,43 @@ def save_yaml():
     new_content = request.form['yaml_code']
     with open(CONFIG_PATH, 'w') as f:
         f.write(new_content)
+    # Force the next index() to re-read, even if the write landed within the same mtime tick
+    _yaml_cache["key"] = None
     return jsonify({"status": "success", "message": "Configuration Saved!"})
 
 @app.route('/start_training', methods=['POST'])
 def start_training():
     run_id = request.form.get('run_id')
     mode = request.form.get('mode') # 'new' or 'resume'
+
+    if not run_id or not RUN_ID_PATTERN.fullmatch(run_id):
+        return jsonify({"status": "error", "message": "Run ID may only contain letters, numbers, '_' and '-'"}), 400
     
-    # Construct command
-    # We must cd to 'Python' dir first so mlagents finds the yaml and results folder correctly
-    cmd = f'start cmd /k "title ML-AGENTS: {run_id} && cd .. && mlagents-learn moon_rover_config.yaml --run-id={run_id}'
+    # Construct command (argument list, no shell parsing)
+    cmd = ['mlagents-learn', 'moon_rover_config.yaml', f'--run-id={run_id}']
     
     if mode == 'resume':
-        cmd += ' --resume'
+        cmd.append('--resume')
     else:
         # If new, we might want --force to overwrite if it exists, or just default
-        cmd += ' --force' 
+        cmd.append('--force')
     
-    cmd += '"' # Close the cmd quote
-    
-    os.system(cmd)
+    # Run from the 'Python' dir so mlagents finds the yaml and results folder correctly
+    try:
+        subprocess.Popen(console_command(f'ML-AGENTS: {run_id}', cmd), cwd=PYTHON_DIR, creationflags=NEW_CONSOLE)
+    except OSError as e:
+        return jsonify({"status": "error", "message": f"Could not start mlagents-learn: {e}"}), 500
     return jsonify({"status": "success", "message": f"Training {mode.upper()} started for {run_id}"})
 
 @app.route('/launch_tensorboard')
 def launch_tensorboard():
-    # Opens TensorBoard in a persistent terminal window pointing to 'results'
-    # We navigate to 'Python' folder (..) then run tensorboard on 'results'
-    cmd = 'start cmd /k "title TENSORBOARD && cd .. && tensorboard --logdir results --port 6006"'
-    os.system(cmd)
+    # Opens TensorBoard in a persistent console window pointing to 'results'
+    try:
+        # Relative to cwd=PYTHON_DIR, so no absolute checkout path ever reaches cmd.exe's parser
+        cmd = ['tensorboard', '--logdir', 'results', '--port', '6006']
+        subprocess.Popen(console_command('TENSORBOARD', cmd), cwd=PYTHON_DIR, creationflags=NEW_CONSOLE)
+    except OSError as e:
+        return jsonify({"status": "error", "message": f"Could not start TensorBoard: {e}"}), 500
     return jsonify({"status": "success", "message": "TensorBoard Launching..."})
 
 # --- NEW MAP VISUALIZATION ROUTES ---
@@ -78,24 +129,58 @@ def view_map():
 
 @app.route('/get_latest_map')
 def get_latest_map():
-    # Pattern to match the files exported by Unity
-    search_pattern = os.path.join(ASSETS_DIR, "RoverMap_Gen*.json")
-    list_of_files = glob.glob(search_pattern)
+    # Find the newest file exported by Unity (RoverMap_Gen*.json) in a single directory pass
+    latest_file = None
+    latest_time = -1
+    try:
+        it = os.scandir(ASSETS_DIR)
+    except FileNotFoundError:
+        it = None
+
+    if it is not None:
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.startswith("RoverMap_Gen") and name.endswith(".json"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        # Unity replaced/removed this file after it was listed; keep scanning
+                        continue
+                    if st.st_ctime > latest_time:
+                        latest_time, latest_file, latest_stat = st.st_ctime, entry.path, st
     
-    if not list_of_files:
+    if latest_file is None:
         return jsonify({"error": "No map files found in Assets directory."}), 404
-        
-    # Get the latest file based on modification time
-    latest_file = max(list_of_files, key=os.path.getctime)
+
+    # The viewer polls this route; skip read + parse + encode if it already has this file
+    # The file name is part of the payload, so it is hashed into the tag along with mtime/size
+    name_hash = zlib.crc32(os.path.basename(latest_file).encode('utf-8'))
+    etag = f'{name_hash:x}-{latest_stat.st_mtime_ns:x}-{latest_stat.st_size:x}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
     
     try:
-        with open(latest_file, 'r') as f:
-            data = json.load(f)
+        # orjson parses the whole buffer in C; map files can be MB-sized point clouds
+        with open(latest_file, 'rb') as f:
+            if latest_stat.st_size < MMAP_THRESHOLD:
+                data = orjson.loads(f.read())
+            else:
+                # Parse straight from the page cache, without a second copy in a bytes object
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    data = orjson.loads(view)
         # Add metadata about the file
         data['filename'] = os.path.basename(latest_file)
-        return jsonify(data)
+        response = Response(orjson.dumps(data), mimetype='application/json')
+        response.set_etag(etag)
+        # Always revalidate so a newer map is picked up, but allow a cheap 304
+        response.cache_control.no_cache = True
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # All routes are file I/O, so a pool of threads keeps page loads and map polls concurrent
+    serve(app, host='127.0.0.1', port=5000, threads=8)
\ No newline at end of file
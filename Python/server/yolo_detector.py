@@ -1,56 +1,251 @@
 from flask import Flask, render_template, Response, request, jsonify
 import cv2
 import numpy as np
+import os
 import threading
+import queue
+import itertools
 import time
-import random
+import functools
+import torch
+from concurrent.futures import Future, ThreadPoolExecutor
+from waitress import serve
 from ultralytics import YOLO
+from ultralytics.trackers.byte_tracker import BYTETracker
+from ultralytics.utils import IterableSimpleNamespace, yaml_load
+from ultralytics.utils.checks import check_yaml
 
 app = Flask(__name__)
 
 # --- CONFIGURATION ---
 PORT = 8000  # <--- CHANGED TO 8000 (Safe & Standard)
 MODEL_PATH = 'best.pt'
+ENGINE_PATH = 'best.engine'  # TensorRT build of MODEL_PATH, exported on first GPU run
 CONFIDENCE_THRESHOLD = 0.5
 MAX_CAMERAS = 5
+# Each open /video_feed stream holds a server thread, and every dashboard tab opens MAX_CAMERAS of them.
+# Size the pool for that many tabs plus one /detect per camera and a few spare for /stats and page loads
+MAX_DASHBOARD_TABS = 4
+SERVER_THREADS = MAX_CAMERAS * MAX_DASHBOARD_TABS + MAX_CAMERAS + 4
+IMAGE_SIZE = 640  # Inference resolution (letterboxed once inside YOLO)
+# Run on the GPU in FP16 when available (halves memory traffic), else CPU/FP32
+DEVICE = 0 if torch.cuda.is_available() else 'cpu'
+HALF = DEVICE != 'cpu'
+BATCH_WINDOW = 0.010  # Seconds to wait for other cameras' frames before running a batch
+BOX_COLOR = (255, 0, 255)  # BGR Purple/Magenta
+BOX_THICKNESS = 2
+TRACKER_CONFIG = 'bytetrack.yaml'  # Ultralytics' bundled ByteTrack settings
+TRACKER_FRAME_RATE = 10  # Matches CameraStreamer.targetFPS in Unity
+ENCODER_THREADS = 2  # Background threads that annotate + JPEG-encode frames for the web stream
+JPEG_QUALITY = 70  # Stream quality; with 4:2:0 subsampling this roughly halves bandwidth
 
 # Global Storage
-# latest_frames: Stores the processed JPEG bytes for web streaming
-latest_frames = {i: None for i in range(MAX_CAMERAS)}
+# latest_frames: (seq, JPEG bytes) per camera for web streaming, None until the first frame.
+# Each update replaces the whole tuple, so viewers read a consistent pair without taking a lock
+latest_frames = [None] * MAX_CAMERAS
+# frame_seq: Global frame counter, taken in detect() when a frame is queued for encoding.
+# The encoder only stores a frame with a higher seq than the slot holds, and viewers compare
+# seq with the last one they sent to tell whether a frame is new
+frame_seq = itertools.count()
+# frame_conditions: Per camera; the encoder's compare-and-store runs under it, and idle
+# stream generators sleep on it until a new frame is stored
+frame_conditions = {i: threading.Condition() for i in range(MAX_CAMERAS)}
+# viewer_counts: Open /video_feed streams per camera (frames are only annotated when watched)
+viewer_counts = {i: 0 for i in range(MAX_CAMERAS)}
+viewer_lock = threading.Lock()
 # camera_locks: Prevents processing build-up (drops frames if busy)
-camera_locks = {i: False for i in range(MAX_CAMERAS)}
-# rock_counter: A set to track unique rock IDs generated (simulating "different" rocks)
+camera_locks = {i: threading.Lock() for i in range(MAX_CAMERAS)}
+# trackers: One ByteTrack instance per camera, so IDs persist across that camera's frames
+tracker_args = IterableSimpleNamespace(**yaml_load(check_yaml(TRACKER_CONFIG)))
+trackers = {i: BYTETracker(args=tracker_args, frame_rate=TRACKER_FRAME_RATE) for i in range(MAX_CAMERAS)}
+# unique_rock_ids: (camera_id, track_id) pairs of every rock tracked so far
 unique_rock_ids = set()
+# pending_frames: (image, Future) pairs waiting for the batch worker
+pending_frames = queue.Queue()
+# encoder_pool: Keeps stream encoding off the /detect response path
+encoder_pool = ThreadPoolExecutor(max_workers=ENCODER_THREADS)
+# pending_encodes: Newest (seq, image, detections) per camera waiting for the encoder.
+# A newer frame replaces a queued one, so a slow encoder drops stale frames instead of piling them up
+pending_encodes = [None] * MAX_CAMERAS
+pending_lock = threading.Lock()
+
+def export_engine():
+    """Builds ENGINE_PATH from MODEL_PATH with TensorRT."""
+    print("⏳ Exporting TensorRT engine (takes a few minutes)...")
+    # Dynamic batch so one engine serves 1..MAX_CAMERAS frames per pass
+    YOLO(MODEL_PATH).export(format='engine', half=True, dynamic=True, batch=MAX_CAMERAS,
+                            imgsz=IMAGE_SIZE, workspace=4, device=DEVICE)
+
+def warm_up(model):
+    """Runs one full MAX_CAMERAS batch, so a broken engine fails here instead of on every /detect."""
+    blank = np.zeros((IMAGE_SIZE, IMAGE_SIZE, 3), np.uint8)
+    model.predict([blank] * MAX_CAMERAS, imgsz=IMAGE_SIZE, device=DEVICE, half=HALF, verbose=False)
+    return model
+
+def load_model():
+    """Loads the TensorRT engine on GPU (exporting it if missing or stale), else the PyTorch weights."""
+    if DEVICE == 'cpu':
+        return YOLO(MODEL_PATH)
+
+    try:
+        # Rebuild after retraining, otherwise new best.pt weights would be silently ignored
+        exported = False
+        if not os.path.exists(ENGINE_PATH) or os.path.getmtime(ENGINE_PATH) < os.path.getmtime(MODEL_PATH):
+            export_engine()
+            exported = True
+
+        # YOLO() only records the path of an engine; the TensorRT runtime is built on the first predict
+        try:
+            return warm_up(YOLO(ENGINE_PATH, task='detect'))
+        except Exception as e:
+            if exported:
+                raise
+            # An older engine (e.g. a fixed batch-of-1 build) can't run a MAX_CAMERAS batch: rebuild once
+            print(f"⚠️ Existing TensorRT engine failed to run, rebuilding it: {e}")
+            export_engine()
+            return warm_up(YOLO(ENGINE_PATH, task='detect'))
+    except Exception as e:
+        print(f"⚠️ TensorRT engine unavailable, using PyTorch weights: {e}")
+        return YOLO(MODEL_PATH)
+
+# JPEG Codec: PyTurboJPEG talks to libjpeg-turbo's SIMD paths directly,
+# OpenCV is the fallback if the native libturbojpeg library isn't installed
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except Exception as e:
+    print(f"⚠️ TurboJPEG unavailable, falling back to OpenCV: {e}")
+    turbo_jpeg = None
+
+def decode_jpeg(data):
+    """Decodes JPEG bytes to a BGR image, or None if the data isn't a valid image."""
+    if turbo_jpeg is not None:
+        try:
+            return turbo_jpeg.decode(data, pixel_format=TJPF_BGR)
+        except OSError:
+            return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+def encode_jpeg(image):
+    """Encodes a BGR image to JPEG bytes for the web stream."""
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(image, quality=JPEG_QUALITY, jpeg_subsample=TJSAMP_420)
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes()
+
+# Placeholder shown until a camera sends its first frame (encoded once, reused by every viewer)
+_blank = np.zeros((480, 640, 3), np.uint8)
+cv2.putText(_blank, "Waiting for Stream...", (50, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+PLACEHOLDER_FRAME = (b'--frame\r\n'
+                     b'Content-Type: image/jpeg\r\n\r\n' + encode_jpeg(_blank) + b'\r\n')
 
 # Load YOLO Model
 print("⏳ Loading YOLO Model...")
 try:
-    model = YOLO(MODEL_PATH)
+    model = load_model()
     print("✅ Model Loaded.")
 except Exception as e:
     print(f"❌ Error loading model: {e}")
     print("   Ensure 'best.pt' is in the same folder!")
     exit()
 
+def batch_worker():
+    """Coalesces frames from concurrent cameras into a single YOLO forward pass."""
+    while True:
+        items = [pending_frames.get()]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(items) < MAX_CAMERAS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(pending_frames.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            # Pass the decoded BGR arrays straight in; YOLO does the colour/layout conversion once
+            results = model.predict([img for img, _ in items], conf=CONFIDENCE_THRESHOLD,
+                                    imgsz=IMAGE_SIZE, device=DEVICE, half=HALF, verbose=False)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            continue
+
+        for (_, future), result in zip(items, results):
+            future.set_result(result)
+
+threading.Thread(target=batch_worker, daemon=True).start()
+
+def run_yolo(img):
+    """Queues a frame for the batch worker and blocks until its result is ready."""
+    future = Future()
+    pending_frames.put((img, future))
+    return future.result()
+
+@functools.lru_cache(maxsize=256)
+def label_size(label):
+    """Text extent of a box label (cached, labels repeat across frames)."""
+    (w_text, h_text), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)
+    return w_text, h_text
+
 def draw_boxes(image, detections):
     """Draws bounding boxes and data on the frame."""
-    for det in detections:
-        x, y, w, h = det['box']
-        rock_id = det['rock_id']
-        conf = det['confidence']
-        
-        # Draw Box (Purple/Green Theme)
-        # BGR Color: (255, 0, 255) is Purple/Magenta
-        cv2.rectangle(image, (x, y), (x+w, y+h), (255, 0, 255), 2)
-        
+    if not detections:
+        return image
+
+    # Box corners for all detections at once, clipped to the frame
+    height, width = image.shape[:2]
+    boxes = np.array([det['box'] for det in detections], dtype=np.int32)
+    x1 = np.clip(boxes[:, 0], 0, width - 1).tolist()
+    y1 = np.clip(boxes[:, 1], 0, height - 1).tolist()
+    x2 = np.clip(boxes[:, 0] + boxes[:, 2], 0, width - 1).tolist()
+    y2 = np.clip(boxes[:, 1] + boxes[:, 3], 0, height - 1).tolist()
+
+    for det, left, top, right, bottom in zip(detections, x1, y1, x2, y2):
+        # Draw Box as 4 thin strips written straight into the pixel buffer
+        image[top:top + BOX_THICKNESS, left:right + 1] = BOX_COLOR
+        image[max(bottom - BOX_THICKNESS + 1, 0):bottom + 1, left:right + 1] = BOX_COLOR
+        image[top:bottom + 1, left:left + BOX_THICKNESS] = BOX_COLOR
+        image[top:bottom + 1, max(right - BOX_THICKNESS + 1, 0):right + 1] = BOX_COLOR
+
         # Draw Label with background
-        label = f"Rock #{rock_id}"
-        (w_text, h_text), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)
-        cv2.rectangle(image, (x, y - 20), (x + w_text, y), (255, 0, 255), -1)
-        cv2.putText(image, label, (x, y - 5), 
+        label = f"Rock #{det['rock_id']}"
+        w_text, _ = label_size(label)
+        image[max(top - 20, 0):top, left:left + w_text] = BOX_COLOR
+        cv2.putText(image, label, (left, top - 5), 
                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
     return image
 
+def queue_encode(img, detections, camera_id):
+    """Hands a frame to the encoder pool, replacing any frame of this camera still waiting there."""
+    job = (next(frame_seq), img, detections)
+    with pending_lock:
+        already_queued = pending_encodes[camera_id] is not None
+        pending_encodes[camera_id] = job
+    if not already_queued:
+        encoder_pool.submit(encode_and_store, camera_id)
+
+def encode_and_store(camera_id):
+    """Annotates a frame and publishes it to the camera's stream viewers (runs on encoder_pool)."""
+    try:
+        with pending_lock:
+            seq, img, detections = pending_encodes[camera_id]
+            pending_encodes[camera_id] = None
+
+        annotated_img = draw_boxes(img, detections)
+        frame_bytes = encode_jpeg(annotated_img)
+
+        # Two encoders can work on the same camera at once; compare-and-store under the
+        # camera's condition so an older frame never replaces a newer one
+        with frame_conditions[camera_id]:
+            current = latest_frames[camera_id]
+            if current is None or current[0] < seq:
+                latest_frames[camera_id] = (seq, frame_bytes)
+                frame_conditions[camera_id].notify_all()
+    except Exception as e:
+        print(f"Encode Error: {e}")
+
 @app.route('/')
 def index():
     """Renders the Dashboard Website."""
@@ -61,46 +256,48 @@ def detect():
     """Endpoint for Unity to send images."""
     try:
         camera_id = int(request.form.get('camera_id'))
-        
-        # Frame Dropping Logic
-        if camera_locks.get(camera_id, False):
+        lock = camera_locks.get(camera_id)
+        if lock is None:
+            return jsonify({"status": "error", "message": "Unknown camera"}), 400
+
+        # Frame Dropping Logic (non-blocking acquire is an atomic "busy?" check)
+        if not lock.acquire(blocking=False):
             return jsonify({"status": "dropped", "message": "Busy"}), 429
 
-        camera_locks[camera_id] = True
-        
-        # Read Image
-        file = request.files['file']
-        nparr = np.frombuffer(file.read(), np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        if img is None:
-            camera_locks[camera_id] = False
-            return jsonify({"status": "error"}), 400
-
-        # Run YOLO
-        results = model.predict(img, conf=CONFIDENCE_THRESHOLD, verbose=False)
-        detections = []
-
-        for result in results:
-            for box in result.boxes:
-                # Generate a simulated unique ID (In a real scenario, use tracking)
-                # We use a random ID here as per previous request logic
-                rock_id = random.randint(1000, 9999)
-                unique_rock_ids.add(rock_id)
-                
-                x, y, w, h = box.xywh[0].tolist()
-                detections.append({
-                    "rock_id": rock_id,
-                    "confidence": round(float(box.conf[0]), 2),
-                    "box": [int(x - w/2), int(y - h/2), int(w), int(h)]
-                })
-
-        # Process Image for Web Stream
-        annotated_img = draw_boxes(img, detections)
-        _, buffer = cv2.imencode('.jpg', annotated_img)
-        latest_frames[camera_id] = buffer.tobytes()
+        try:
+            # Read Image
+            file = request.files['file']
+            img = decode_jpeg(file.read())
+
+            if img is None:
+                return jsonify({"status": "error"}), 400
+
+            # Run YOLO
+            result = run_yolo(img)
+
+            # Track across this camera's frames (rows: x1, y1, x2, y2, track_id, score, cls, idx)
+            # result.boxes comes off the GPU in a single copy for the whole frame
+            tracks = trackers[camera_id].update(result.boxes.cpu().numpy(), img)
+            detections = []
+
+            if len(tracks):
+                # Convert every column at once in numpy, then build the dicts in one pass
+                boxes = tracks[:, :4].copy()
+                boxes[:, 2:] -= boxes[:, :2]  # x2, y2 -> w, h
+                boxes = boxes.astype(np.int32).tolist()
+                rock_ids = tracks[:, 4].astype(np.int64).tolist()
+                confidences = np.round(tracks[:, 5].astype(np.float64), 2).tolist()
 
-        camera_locks[camera_id] = False
+                unique_rock_ids.update((camera_id, rock_id) for rock_id in rock_ids)
+                detections = [{"rock_id": rock_id, "confidence": conf, "box": box}
+                              for rock_id, conf, box in zip(rock_ids, confidences, boxes)]
+
+            # Process Image for Web Stream in the background (skipped while nobody is watching)
+            # img is freshly decoded for this request and not touched again, so no copy is needed
+            if viewer_counts[camera_id] > 0:
+                queue_encode(img, detections, camera_id)
+        finally:
+            lock.release()
         
         return jsonify({
             "status": "success", 
@@ -108,33 +305,44 @@ def detect():
         })
 
     except Exception as e:
-        if 'camera_id' in locals():
-            camera_locks[camera_id] = False
         print(f"Error: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 def generate_frames(camera_id):
     """Generator function for streaming video to HTML."""
-    while True:
-        frame_bytes = latest_frames.get(camera_id)
-        if frame_bytes:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        else:
-            # If no frame yet, yield a placeholder (black image)
-            # This prevents the browser connection from timing out
-            blank = np.zeros((480, 640, 3), np.uint8)
-            cv2.putText(blank, "Waiting for Stream...", (50, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-            _, buffer = cv2.imencode('.jpg', blank)
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-            time.sleep(1) # Slow retry if disconnected
-        
-        time.sleep(0.05) # Limit stream FPS to save CPU
+    condition = frame_conditions[camera_id]
+    with viewer_lock:
+        viewer_counts[camera_id] += 1
+    try:
+        while True:
+            # Something is sent on every pass: a new frame when one arrived, otherwise the
+            # last frame (or placeholder) again after the 1s timeout. The server only notices
+            # a closed tab when a write fails, so this keeps dead streams from holding a thread
+            frame = latest_frames[camera_id]  # Lock-free read of the (seq, bytes) pair
+            if frame is None:
+                # If no frame yet, yield a placeholder (black image)
+                # This prevents the browser connection from timing out
+                last_seq = None
+                yield PLACEHOLDER_FRAME
+            else:
+                last_seq, frame_bytes = frame
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+
+            # Sleep until encode_and_store() publishes a frame with a new seq (timeout = keepalive resend)
+            with condition:
+                current = latest_frames[camera_id]
+                if current is None or current[0] == last_seq:
+                    condition.wait(timeout=1.0)
+    finally:
+        with viewer_lock:
+            viewer_counts[camera_id] -= 1
 
 @app.route('/video_feed/<int:camera_id>')
 def video_feed(camera_id):
     """Route for the <img> tag source."""
+    if camera_id not in frame_conditions:
+        return jsonify({"status": "error", "message": "Unknown camera"}), 404
     return Response(generate_frames(camera_id),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
@@ -144,6 +352,7 @@ def stats():
     return jsonify({"total_rocks": len(unique_rock_ids)})
 
 if __name__ == '__main__':
-    # Threaded=True is important for handling multiple camera streams + web requests
+    # Single process (the model lives on the GPU once), with a thread pool so
+    # the batch worker can coalesce concurrent /detect calls from every camera
     print(f"🚀 Dashboard running at http://localhost:{PORT}")
-    app.run(host='0.0.0.0', port=PORT, threaded=True)
\ No newline at end of file
+    serve(app, host='0.0.0.0', port=PORT, threads=SERVER_THREADS)
\ No newline at end of file